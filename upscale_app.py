@@ -1,47 +1,292 @@
 import streamlit as st
+import PIL
 from PIL import Image
-import requests
+import asyncio
+import aiohttp
 import io
+import mmap
+import hashlib
 import time
+import random
 import os
 import secrets
 import tempfile
 import json
-from image_upscaling_api import upload_image, get_uploaded_images
+from urllib.parse import quote, unquote
+import shutil
+import atexit
+import threading
+import image_upscaling_api
+from image_upscaling_api import upload_image
 
 # --- CONFIG ---
 # TARGET_SIZE = (10629, 15354) # Original hardcoded target size
 TARGET_DPI_VALUE = 300 # Keep DPI as a single value for calculations
 TARGET_DPI = (TARGET_DPI_VALUE, TARGET_DPI_VALUE) # For PIL save
 API_SCALE = 4
+assert API_SCALE == 4, "n_steps calculation assumes 4x API passes (two bits of scale per pass)"
 CM_TO_INCH = 1 / 2.54
+RESIZE_REDUCING_GAP = 3.0 # Cheap box pre-reduce before LANCZOS; higher is closer to pure LANCZOS
+BILINEAR_MAX_FACTOR = 1.15 # Final downscale factors up to this use BILINEAR
+BICUBIC_MAX_FACTOR = 2.5 # ...up to this use BICUBIC, anything larger LANCZOS
+PREVIEW_SIZE = (1200, 1200) # Bounding box for on-screen previews of large images
+# Higher-quality print encode: q92 instead of Pillow's default 75 (larger files, slightly slower).
+# 4:2:0 chroma, no optimize and baseline (non-progressive) are Pillow's defaults, spelled out here
+JPEG_SAVE_OPTIONS = {"quality": 92, "subsampling": 2, "optimize": False, "progressive": False}
+POLL_TIMEOUT = 600 # Seconds to wait for each API pass
+POLL_BASE_DELAY = 1.0 # First poll interval, grows exponentially
+POLL_MAX_DELAY = 15.0 # Cap on the poll interval
+
+# Print-size API outputs (e.g. 10629 × 15354) exceed Pillow's decompression-bomb limit, so the
+# global check is off for the process and _open_image enforces a limit on uploads instead.
+# Streamlit re-executes this module on every rerun, so it is only ever assigned, never read back.
+Image.MAX_IMAGE_PIXELS = None
+UPLOAD_MIN_MAX_PIXELS = 1024 * 1024 * 1024 // 4 // 3 # Pillow's stock MAX_IMAGE_PIXELS (~89.5 MP)
+
+# Same endpoint image_upscaling_api.get_uploaded_images() hits, polled here without blocking
+API_IMAGES_URL = image_upscaling_api.server_url + "imageupscaling/get_images_client.php"
+API_TIMEOUT = aiohttp.ClientTimeout(sock_connect=10, sock_read=300) # (connect, read) seconds
+HTTP_POOL_SIZE = 4 # Keep-alive connections shared by polls and downloads
+COPY_CHUNK_SIZE = 1 << 20 # Stream files to disk in 1 MiB chunks
+PROGRESS_REFRESH = 0.5 # Seconds between progress updates while a transfer runs
+
+SCRATCH_PREFIX = "upscale_app_scratch_" # Per-session scratch dirs in the system temp dir
+SCRATCH_MARKER = ".upscale_app_scratch" # Written into every scratch dir; only marked dirs are ever deleted
+SCRATCH_MAX_AGE = 24 * 3600 # Seconds before an untouched scratch dir from an ended session is swept
 
 # --- CLIENT ID MANAGEMENT PER IMAGE ---
+# Flat "name<TAB>client_id" lines: this file is only ever read and written by this app.
+# Names are percent-encoded, so a tab or newline in an upload's name can't break the format
+CLIENT_ID_MAP_PATH = os.path.join(tempfile.gettempdir(), 'upscale_client_id_map.tsv')
+
+@st.cache_resource
+def _load_client_id_map():
+    # Read once per server process; new entries are added to this dict in place. Sessions run
+    # on separate threads and Streamlit re-executes this module on every rerun, so the lock
+    # guarding the dict and file has to come from here too: a module-level one is new each run
+    mapping = {}
+    lock = threading.Lock()
+    if not os.path.exists(CLIENT_ID_MAP_PATH):
+        return mapping, lock
+    # Undecodable bytes are replaced rather than raised; such lines then fail the checks below
+    with open(CLIENT_ID_MAP_PATH, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            name, sep, client_id = line.rstrip('\n').partition('\t')
+            # Malformed lines (no tab, or not a 32-digit ID) are skipped
+            if sep and len(client_id) == 32:
+                mapping[unquote(name)] = client_id
+    return mapping, lock
+
 def get_or_create_client_id_for_image(image_name):
-    temp_dir = tempfile.gettempdir()
-    mapping_path = os.path.join(temp_dir, 'upscale_client_id_map.json')
-    # Load or create the mapping
-    if os.path.exists(mapping_path):
-        with open(mapping_path, 'r') as f:
+    mapping, lock = _load_client_id_map()
+    with lock:
+        # Use the image name as the key
+        if image_name in mapping and len(mapping[image_name]) == 32:
+            return mapping[image_name]
+        # Generate new 32-digit hex client ID
+        client_id = secrets.token_hex(16)
+        updated = {**mapping, image_name: client_id}
+        # Write to a sibling temp file and swap it in so readers never see a partial map
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(CLIENT_ID_MAP_PATH), suffix='.tsv')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.writelines(f"{quote(name, safe='')}\t{cid}\n" for name, cid in updated.items())
+        os.replace(tmp_path, CLIENT_ID_MAP_PATH)
+        mapping[image_name] = client_id
+        return client_id
+
+# --- API TRANSFER HELPERS ---
+# The waits for the API run on an asyncio event loop, so the script thread sits in
+# the selector instead of time.sleep and one aiohttp session keeps connections warm
+# across every poll and download of a job.
+def _upload_pass(path, client_id):
+    # image_upscaling_api is synchronous; this runs in a worker thread via asyncio.to_thread
+    upload_image(path, client_id, scale=API_SCALE, use_face_enhance=False)
+    return path
+
+async def _fetch_completed(http, client_id):
+    async with http.get(API_IMAGES_URL, cookies={"client_id": client_id}) as response:
+        response.raise_for_status()
+        # The endpoint does not always send a JSON content type, so parse the text ourselves
+        data = json.loads(await response.text())
+    return [image_upscaling_api.server_url + "imageupscaling/" + i for i in data["images2"]]
+
+async def _wait_for_completion(http, client_id):
+    deadline = time.monotonic() + POLL_TIMEOUT  # Wait up to 10 minutes
+    wait_idx = 0
+    while time.monotonic() < deadline:
+        completed = await _fetch_completed(http, client_id)
+        st.write(f"[LOG] Poll {wait_idx+1}: {len(completed)} completed images found.")
+        if completed:
+            return completed[-1]
+        # Exponential backoff with jitter, never sleeping past the deadline
+        delay = min(POLL_MAX_DELAY, POLL_BASE_DELAY * (1.6 ** wait_idx)) + random.uniform(0, 0.5)
+        await asyncio.sleep(max(0.0, min(delay, deadline - time.monotonic())))
+        wait_idx += 1
+    return None
+
+async def _download_pass(http, url, path, on_progress):
+    async with http.get(url) as response:
+        response.raise_for_status()
+        written = 0
+        last_report = time.monotonic()
+        with open(path, "wb") as f:
+            async for chunk in response.content.iter_chunked(COPY_CHUNK_SIZE):
+                f.write(chunk)
+                written += len(chunk)
+                if time.monotonic() - last_report >= PROGRESS_REFRESH:
+                    on_progress(written)
+                    last_report = time.monotonic()
+    return path
+
+async def _run_api_passes(client_id, input_path, n_steps, scratch_paths, progress):
+    # Returns the path of the last pass's output, or None (after showing st.error) if the API
+    # timed out or returned an empty image.
+    # Each pass's upload starts the moment the previous download lands.
+    current_path = input_path
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE)
+    async with aiohttp.ClientSession(connector=connector, timeout=API_TIMEOUT) as http:
+        upload_task = asyncio.create_task(asyncio.to_thread(_upload_pass, current_path, client_id))
+        for attempt in range(n_steps):
+            st.write(f"**[LOG] Starting upscaling pass {attempt+1} of {n_steps}...**")
+            progress.progress((attempt) / n_steps, text=f"Upscaling pass {attempt+1} of {n_steps} (4x)...")
+            await upload_task
+            st.write(f"**[LOG] Image sent to API for pass {attempt+1}. Waiting for processing...**")
+            # Wait for completion
+            with st.spinner(f"Waiting for API processing (pass {attempt+1})..."):
+                upscaled_url = await _wait_for_completion(http, client_id)
+            if not upscaled_url:
+                st.error("Upscaling failed or timed out.")
+                return None
+            st.write(f"**[LOG] Upscaled image URL received: {upscaled_url}**")
+            # Download upscaled image
+            st.write(f"**[LOG] Downloading upscaled image for pass {attempt+1}...**")
+            upscaled_path = scratch_paths[attempt % 2]
+
+            def report_download(written, attempt=attempt):
+                mb = written / (1 << 20)
+                progress.progress((attempt + 0.5) / n_steps, text=f"Downloading pass {attempt+1} of {n_steps} ({mb:.1f} MB)...")
+
+            previous_path = current_path
+            current_path = await _download_pass(http, upscaled_url, upscaled_path, report_download)
+            # An empty body would otherwise be re-uploaded, and mmap() rejects zero-byte files
+            if os.path.getsize(current_path) == 0:
+                st.error(f"Upscaling failed: the API returned an empty image for pass {attempt+1}.")
+                return None
+            # The previous intermediate was already uploaded for this pass; free its disk space
+            if previous_path != input_path:
+                os.remove(previous_path)
+            if attempt + 1 < n_steps:
+                upload_task = asyncio.create_task(asyncio.to_thread(_upload_pass, current_path, client_id))
+            st.write(f"**[LOG] Upscaled image saved to {upscaled_path}.**")
+    return current_path
+
+# --- LOCAL RESIZE HELPERS ---
+RESAMPLE_FILTERS = {"BILINEAR": Image.BILINEAR, "BICUBIC": Image.BICUBIC, "LANCZOS": Image.LANCZOS}
+
+def _open_image(fp, max_pixels):
+    # Image.open only parses the header, so the size check below runs before any pixels are
+    # decoded. max_pixels=None is only for files the API produced; uploads pass a finite limit
+    img = Image.open(fp)
+    if max_pixels is not None and img.width * img.height > max_pixels:
+        img.close()
+        raise Image.DecompressionBombError(f"Image size ({img.width * img.height} pixels) exceeds limit of {max_pixels} pixels")
+    return img
+
+def _load_preview(path, max_pixels=None):
+    # Separate handle for display. thumbnail() calls draft() itself, so JPEGs are decoded
+    # at reduced scale, and it keeps the bitmap sent to the browser small
+    preview_img = _open_image(path, max_pixels)
+    preview_img.thumbnail(PREVIEW_SIZE)
+    return preview_img
+
+def _resize_to_file(path, source_key, target, dpi, resample_name, output_stem):
+    # The output name encodes every argument, so each distinct call owns its own file and
+    # a later call with other settings can never overwrite one a cache entry points to
+    source_tag = hashlib.sha1(repr((path, source_key)).encode()).hexdigest()[:10]
+    # Decode straight from a read-only mapping of the file: the decoder's reads are served
+    # from the page cache. (Wrapping it in io.BytesIO would copy the whole file again.)
+    with open(path, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        upscaled_img = _open_image(mm, None)
+        if upscaled_img.size == tuple(target):
+            # Already at target dims: only the DPI metadata changes, so re-save as-is
+            upscaled_img.load()
+            final_img = upscaled_img
+        else:
+            # Box-reduce to within RESIZE_REDUCING_GAP× of the target first, so the filter runs on a far smaller buffer
+            final_img = upscaled_img.resize(target, RESAMPLE_FILTERS[resample_name], reducing_gap=RESIZE_REDUCING_GAP)
+            # Drop the full-size decode now so only the target-size image is live during the encode
+            upscaled_img.close()
+        del upscaled_img
+    # Keep alpha intact as PNG; everything else is encoded as a print-tuned JPEG
+    has_alpha = final_img.mode in ("RGBA", "LA") or (final_img.mode == "P" and "transparency" in final_img.info)
+    if has_alpha:
+        final_format, final_ext, save_options = "PNG", "png", {}
+    else:
+        final_format, final_ext, save_options = "JPEG", "jpg", JPEG_SAVE_OPTIONS
+        if final_img.mode not in ("RGB", "L", "CMYK"):
+            final_img = final_img.convert("RGB")
+    final_path = f"{output_stem}_{target[0]}x{target[1]}_{dpi[0]}dpi_{resample_name.lower()}_{source_tag}.{final_ext}"
+    with open(final_path, "wb") as f:
+        final_img.save(f, final_format, dpi=dpi, **save_options)
+    return final_path
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _resize_and_save(path, source_key, target, dpi, resample_name, output_stem):
+    # source_key identifies the upscaled result (uploaded file_id + pass count) and stays the
+    # same across reruns, so the resize is skipped without hashing a multi-hundred-MB image
+    return _resize_to_file(path, source_key, target, dpi, resample_name, output_stem)
+
+# --- SESSION SCRATCH HELPERS ---
+def _remove_scratch_dirs(max_age=None):
+    # Deletes this app's scratch dirs (prefix *and* marker file) in the system temp dir,
+    # either all of them or only those untouched for longer than max_age seconds
+    cutoff = None if max_age is None else time.time() - max_age
+    with os.scandir(tempfile.gettempdir()) as entries:
+        for entry in entries:
+            if not entry.name.startswith(SCRATCH_PREFIX) or not entry.is_dir(follow_symlinks=False):
+                continue
+            if not os.path.isfile(os.path.join(entry.path, SCRATCH_MARKER)):
+                continue
             try:
-                mapping = json.load(f)
-            except Exception:
-                mapping = {}
+                if cutoff is None or entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except FileNotFoundError:
+                pass
+
+@st.cache_resource
+def _register_scratch_cleanup():
+    # One exit handler per process (not per session) that removes every scratch dir
+    atexit.register(_remove_scratch_dirs)
+
+def _get_scratch_dir():
+    scratch_dir = st.session_state.get("scratch")
+    if not scratch_dir or not os.path.isdir(scratch_dir):
+        # Streamlit has no session-end hook, so dirs left by ended sessions are removed by age
+        # whenever a new one is created, rather than piling up until the process exits
+        _remove_scratch_dirs(SCRATCH_MAX_AGE)
+        _register_scratch_cleanup()
+        scratch_dir = tempfile.mkdtemp(prefix=SCRATCH_PREFIX)
+        open(os.path.join(scratch_dir, SCRATCH_MARKER), "w").close()
+        st.session_state["scratch"] = scratch_dir
     else:
-        mapping = {}
-    # Use the image name as the key
-    if image_name in mapping and len(mapping[image_name]) == 32:
-        return mapping[image_name]
-    # Generate new 32-digit hex client ID
-    client_id = secrets.token_hex(16)
-    mapping[image_name] = client_id
-    with open(mapping_path, 'w') as f:
-        json.dump(mapping, f)
-    return client_id
+        # Mark the dir as in use so the age sweep only ever removes idle sessions' dirs
+        os.utime(scratch_dir)
+    return scratch_dir
+
+def _clear_scratch():
+    # Runs as a button callback, before the rerun: also resets the uploader (via its key)
+    # so the rerun does not immediately upload the same image again
+    shutil.rmtree(st.session_state.pop("scratch", ""), ignore_errors=True)
+    st.session_state.pop("api_result", None)
+    st.session_state.pop("input_file_id", None)
+    st.session_state["uploader_generation"] = st.session_state.get("uploader_generation", 0) + 1
 
 st.title("Image Upscaler (Auto 4x Steps) with image-upscaling.net API")
 
 st.sidebar.header("Target Output Settings")
+# Pillow-SIMD tags its releases ".postN"; stock Pillow means the final resize runs without AVX2
+if "post" not in PIL.__version__:
+    st.sidebar.warning(f"Pillow-SIMD not detected (PIL {PIL.__version__}); the final resize will be slower.")
 target_width_cm = st.sidebar.number_input("Target Width (cm)", min_value=1.0, value=26.99, step=0.1)
 target_height_cm = st.sidebar.number_input("Target Height (cm)", min_value=1.0, value=38.99, step=0.1)
 st.sidebar.info(f"Target DPI: {TARGET_DPI_VALUE}")
@@ -53,84 +298,142 @@ TARGET_SIZE = (target_width_px, target_height_px)
 
 st.sidebar.write(f"Calculated Target Pixels: {target_width_px} × {target_height_px}")
 
-uploaded_file = st.file_uploader("Upload an image (JPEG/PNG)", type=["jpg", "jpeg", "png"])
+force_lanczos = st.sidebar.checkbox(
+    "Always use LANCZOS for final resize",
+    value=False,
+    help=f"By default the final downscale uses BILINEAR when within {BILINEAR_MAX_FACTOR}× of the target and BICUBIC up to {BICUBIC_MAX_FACTOR}×, "
+         "which is visually indistinguishable at print DPI and much faster. Tick to always use the sharper, slower LANCZOS filter.",
+)
+
+# --- SESSION SCRATCH DIRECTORY ---
+# Every file this session writes (input copy, intermediate passes, final output) lives in one
+# temp dir created on first upload, so nothing lands in the app's working directory. It is
+# removed by the button below, by the age sweep, or at process exit.
+st.sidebar.button(
+    "Clear scratch files",
+    on_click=_clear_scratch,
+    help="Delete this session's uploaded, intermediate and final images from disk and reset the uploader.",
+)
+
+uploaded_file = st.file_uploader(
+    "Upload an image (JPEG/PNG)",
+    type=["jpg", "jpeg", "png"],
+    key=f"uploader_{st.session_state.get('uploader_generation', 0)}",
+)
 
 if uploaded_file:
+    scratch_dir = _get_scratch_dir()
     # Save uploaded image to disk
-    input_path = f"input_{uploaded_file.name}"
-    with open(input_path, "wb") as f:
-        f.write(uploaded_file.read())
+    # Streamlit reruns the script on every widget interaction; only write the upload once
+    input_path = os.path.join(scratch_dir, f"input_{uploaded_file.name}")
+    if st.session_state.get("input_file_id") != uploaded_file.file_id or not os.path.exists(input_path):
+        with open(input_path, "wb") as f:
+            shutil.copyfileobj(uploaded_file, f, length=COPY_CHUNK_SIZE)
+        st.session_state["input_file_id"] = uploaded_file.file_id
 
     # Get or create client ID for this image name
     client_id = get_or_create_client_id_for_image(uploaded_file.name)
     st.caption(f"Session client ID for this image: `{client_id}` (auto-managed)")
     st.write("**[LOG] Image uploaded and client ID assigned.**")
 
-    # Show original image and metadata
-    orig_img = Image.open(input_path)
+    # Show original image and metadata. Only the header is read here; pixels are
+    # decoded once, at reduced scale, for the preview. Uploads larger than the target
+    # (or Pillow's default limit, whichever is bigger) are rejected before any decode
+    upload_max_pixels = max(UPLOAD_MIN_MAX_PIXELS, TARGET_SIZE[0] * TARGET_SIZE[1])
+    try:
+        with _open_image(input_path, upload_max_pixels) as orig_img:
+            orig_width, orig_height, orig_format, orig_mode = orig_img.width, orig_img.height, orig_img.format, orig_img.mode
+    except Image.DecompressionBombError:
+        st.error(f"Uploaded image is too large (limit {upload_max_pixels:,} pixels).")
+        st.stop()
     st.subheader("Original Image")
-    st.image(orig_img, caption="Original", use_container_width=True)
-    st.write(f"**Dimensions:** {orig_img.width} × {orig_img.height}")
-    st.write(f"**Format:** {orig_img.format}")
-    st.write(f"**Mode:** {orig_img.mode}")
+    preview_img = _load_preview(input_path, upload_max_pixels)
+    st.image(preview_img, caption="Original", use_container_width=True)
+    preview_img.close()
+    st.write(f"**Dimensions:** {orig_width} × {orig_height}")
+    st.write(f"**Format:** {orig_format}")
+    st.write(f"**Mode:** {orig_mode}")
 
     # --- DETERMINE UPSCALE STEPS ---
-    width_scale = TARGET_SIZE[0] / orig_img.width
-    height_scale = TARGET_SIZE[1] / orig_img.height
+    width_scale = TARGET_SIZE[0] / orig_width
+    height_scale = TARGET_SIZE[1] / orig_height
     scale_factor = max(width_scale, height_scale)
-    import math
-    n_steps = math.ceil(math.log(scale_factor, API_SCALE))
+    # Smallest n with 4**n >= ceil(ratio), in exact integer math: log2 of the ratio is
+    # (m - 1).bit_length() and each 4x pass covers two bits. Float log() can round an
+    # exact power of 4 up and add a whole API pass.
+    max_dim_ratio_ceil = max(-(-TARGET_SIZE[0] // orig_width), -(-TARGET_SIZE[1] // orig_height))
+    n_steps = 0 if max_dim_ratio_ceil <= 1 else ((max_dim_ratio_ceil - 1).bit_length() + 1) // 2
     st.write(f"**Required upscaling steps (4x each):** {n_steps}")
     st.write(f"**[LOG] Calculated scale factor: {scale_factor:.2f}, steps needed: {n_steps}**")
 
     # --- API UPSCALING LOOP WITH PROGRESS BAR ---
-    current_path = input_path
-    progress = st.progress(0, text="Upscaling in progress...")
-    for attempt in range(n_steps):
-        st.write(f"**[LOG] Starting upscaling pass {attempt+1} of {n_steps}...**")
-        progress.progress((attempt) / n_steps, text=f"Upscaling pass {attempt+1} of {n_steps} (4x)...")
-        upload_image(current_path, client_id, scale=API_SCALE, use_face_enhance=False)
-        st.write(f"**[LOG] Image sent to API for pass {attempt+1}. Waiting for processing...**")
-        # Wait for completion
-        upscaled_url = None
-        with st.spinner(f"Waiting for API processing (pass {attempt+1})..."):
-            for wait_idx in range(60):  # Wait up to 10 minutes
-                _, completed, _ = get_uploaded_images(client_id)
-                st.write(f"[LOG] Poll {wait_idx+1}/60: {len(completed)} completed images found.")
-                if completed:
-                    upscaled_url = completed[-1]["url"] if isinstance(completed[-1], dict) and "url" in completed[-1] else completed[-1]
-                    st.write(f"**[LOG] Upscaled image URL received: {upscaled_url}**")
-                    break
-                time.sleep(10)
-        if not upscaled_url:
-            st.error("Upscaling failed or timed out.")
+    # Passes alternate between two scratch files: pass N+1 reads the file pass N wrote,
+    # so only the latest two intermediates ever exist on disk
+    input_ext = os.path.splitext(uploaded_file.name)[1]
+    scratch_paths = [os.path.join(scratch_dir, f"upscaled_a{input_ext}"), os.path.join(scratch_dir, f"upscaled_b{input_ext}")]
+    # The API result is kept per session, so reruns (download click, filter toggle) reuse it
+    # instead of uploading again and producing a new file
+    job_key = (uploaded_file.file_id, n_steps)
+    api_result = st.session_state.get("api_result")
+    if api_result and api_result["key"] == job_key and os.path.exists(api_result["path"]):
+        current_path = api_result["path"]
+        st.write("**[LOG] Reusing upscaled image from an earlier run.**")
+    else:
+        progress = st.progress(0, text="Upscaling in progress...")
+        current_path = asyncio.run(_run_api_passes(client_id, input_path, n_steps, scratch_paths, progress)) if n_steps else input_path
+        if current_path is None:
             st.stop()
-        # Download upscaled image
-        st.write(f"**[LOG] Downloading upscaled image for pass {attempt+1}...**")
-        response = requests.get(upscaled_url)
-        upscaled_path = f"upscaled_{attempt+1}_{uploaded_file.name}"
-        with open(upscaled_path, "wb") as f:
-            f.write(response.content)
-        st.write(f"**[LOG] Upscaled image saved to {upscaled_path}.**")
-        current_path = upscaled_path
-    progress.progress(1.0, text="Upscaling complete!")
-    st.write("**[LOG] All upscaling passes complete. Proceeding to local resize.**")
+        st.session_state["api_result"] = {"key": job_key, "path": current_path}
+        progress.progress(1.0, text="Upscaling complete!")
+        st.write("**[LOG] All upscaling passes complete. Proceeding to local resize.**")
 
     # --- LOCAL RESIZE ---
     st.info("Resizing to target dimensions and setting DPI...")
-    upscaled_img = Image.open(current_path)
-    st.image(upscaled_img, caption="Upscaled", use_container_width=True)
-    final_img = upscaled_img.resize(TARGET_SIZE, Image.LANCZOS)
-    final_path = f"final_upscaled_{uploaded_file.name}"
-    final_img.save(final_path, dpi=TARGET_DPI)
+    preview_img = _load_preview(current_path)
+    st.image(preview_img, caption="Upscaled", use_container_width=True)
+    preview_img.close()
+    # Header-only read: width/height come from the file header without decoding pixels
+    with _open_image(current_path, None) as upscaled_img:
+        upscaled_size = upscaled_img.size
+        final_factor = max(upscaled_img.width / target_width_px, upscaled_img.height / target_height_px)
+    # Pick the cheapest filter adequate for the remaining downscale factor
+    if force_lanczos or final_factor > BICUBIC_MAX_FACTOR:
+        resample_name = "LANCZOS"
+    elif final_factor > BILINEAR_MAX_FACTOR:
+        resample_name = "BICUBIC"
+    else:
+        resample_name = "BILINEAR"
+    if upscaled_size == TARGET_SIZE:
+        st.write("**[LOG] Upscaled image already matches target dimensions; skipping resize.**")
+    else:
+        st.write(f"**[LOG] Final resize factor {final_factor:.2f}, using {resample_name} filter.**")
+    resize_args = (
+        current_path,
+        job_key,
+        TARGET_SIZE,
+        TARGET_DPI,
+        resample_name,
+        os.path.join(scratch_dir, f"final_upscaled_{os.path.splitext(uploaded_file.name)[0]}"),
+    )
+    final_path = _resize_and_save(*resize_args)
+    if not os.path.exists(final_path):
+        # Cached entry points at a file that has since been deleted. The path is derived from
+        # the arguments, so re-running just this call recreates it; other entries stay valid
+        final_path = _resize_to_file(*resize_args)
     st.write(f"**[LOG] Final image resized and saved to {final_path}.**")
 
     # --- DISPLAY FINAL IMAGE AND METADATA ---
     st.subheader("Upscaled Image (to 300 DPI)")
-    st.image(final_img, caption="Upscaled and resized", use_container_width=True)
-    st.write(f"**Dimensions:** {final_img.width} × {final_img.height}")
-    st.write(f"**Format:** {final_img.format if final_img.format else 'JPEG'}")
-    st.write(f"**Mode:** {final_img.mode}")
+    final_preview = _load_preview(final_path)
+    st.image(final_preview, caption="Upscaled and resized", use_container_width=True)
+    final_preview.close()
+    with _open_image(final_path, None) as final_img:
+        final_format = final_img.format
+        st.write(f"**Dimensions:** {final_img.width} × {final_img.height}")
+        st.write(f"**Format:** {final_format}")
+        st.write(f"**Mode:** {final_img.mode}")
+    final_ext = "png" if final_format == "PNG" else "jpg"
+    final_mime = Image.MIME.get(final_format, "image/jpeg")
     st.write(f"**DPI:** {TARGET_DPI[0]} x {TARGET_DPI[1]}")
     st.write("**[LOG] Processing complete. Ready for download.**")
 
@@ -139,8 +442,9 @@ if uploaded_file:
         st.download_button(
             label="Download Upscaled Image (300 DPI)",
             data=f,
-            file_name=f"upscaled_{os.path.splitext(uploaded_file.name)[0]}_300dpi.jpg",
-            mime="image/jpeg"
+            file_name=f"upscaled_{os.path.splitext(uploaded_file.name)[0]}_300dpi.{final_ext}",
+            mime=final_mime,
+            on_click="ignore",
         )
 else:
     st.info("Please upload an image to begin.") 
\ No newline at end of file